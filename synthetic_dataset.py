@@ -1,51 +1,605 @@
+import functools
+import hashlib
+import inspect
+import json
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np 
-import random
+
+__version__ = "0.2.0"
+
+_BLOCK_SIZE = 2**16 # Rows per independently seeded block of sampled output
+
+####################
+### Layout Cache ###
+####################
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+class _LRUCache:
+    # Bounded least recently used cache shared by the layout helpers it decorates
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            with self._lock:
+                if key in self._data:
+                    self.hits += 1
+                    self._data.move_to_end(key)
+                    return self._data[key]
+                self.misses += 1
+
+            value = func(*args)
+            value.setflags(write=False) # Shared between calls
+            with self._lock:
+                self._data[key] = value
+                self._evict()
+
+            return value
+
+        return wrapper
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+_layout_cache = _LRUCache(maxsize=128)
+
+def layout_cache_info():
+    """ Statistics of the cache of mode means and covariance factors.
+
+    Returns
+    -------
+    info : CacheInfo
+        Named tuple of the cache hits, misses, maxsize and current size.
+    """
+
+    return _layout_cache.info()
+
+def set_layout_cache_size(maxsize):
+    """ Set the number of mode means and covariance factors kept in the cache.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of cached entries. The least recently used entries are evicted first.
+        0 disables caching.
+    """
+
+    if maxsize<0:
+        raise ValueError("Invalid cache size. Must be >=0.")
+    _layout_cache.resize(maxsize)
+
+def clear_layout_cache():
+    """ Empty the cache of mode means and covariance factors and reset its statistics. """
+
+    _layout_cache.clear()
 
 #########################
 ### Utility Functions ###
 #########################
 
-def _get_samples_per_mode(samples, modes, sample_weights):
+def _get_weights(modes, sample_weights):
     ### Weight number of samples per mode
     if sample_weights:
-        sample_weights = [float(w) / sum(sample_weights) for w in sample_weights] # Normalize weights to sum to 1
-        samples_per_mode = [int(samples*w) for w in sample_weights]
+        weights = np.asarray(sample_weights, dtype=np.float64)
+        weights = weights / weights.sum() # Normalize weights to sum to 1
     else:
-        samples_per_mode = [int(np.ceil(samples / modes)) for i in range(modes)] # Equal weighting
+        weights = np.full(modes, 1.0 / modes) # Equal weighting
+
+    return weights
+
+def _get_samples_per_mode(samples, modes, sample_weights):
+    weights = _get_weights(modes, sample_weights)
+
+    ### Largest remainder apportionment so that the counts sum to exactly `samples`
+    quotas = samples * weights
+    samples_per_mode = np.floor(quotas).astype(np.intp)
+    remainder = samples - samples_per_mode.sum()
+    if remainder > 0:
+        order = np.argsort(samples_per_mode - quotas, kind="stable") # Largest fractional part first
+        samples_per_mode[order[:remainder]] += 1
 
     return samples_per_mode
 
 def _get_covariance(variance):
     # Calculate covariance matrix
-    if type(variance) is list:
+    if type(variance) is list and np.ndim(variance) == 2:
+        cov = np.array(variance, dtype=np.float64) # Full covariance matrix
+        if cov.shape != (2, 2):
+            raise ValueError("Incorrect covariance shape. Should be a 2x2 nested list.")
+    elif type(variance) is list:
         cov = np.diagflat(variance)
     else:
         cov = np.diagflat([variance, variance])
 
     return cov
 
-def _sample(samples, means, cov, samples_per_mode, random_state):
-    np.random.seed(random_state)
-    
-    ### Sample at each mode
-    data = []
-    for i, mean in enumerate(means):
-        mode_pts = np.random.multivariate_normal(mean, cov, samples_per_mode[i]).T 
-        mode_pts = [[x,y] for x,y in zip(mode_pts[0], mode_pts[1])]
-        data.extend(mode_pts)
-    
-    ### Fix data size from weighted sample rounding error
-    if len(data) != samples:
-        for i in range(len(data) - samples):
-            data.remove(random.choice(data)) # Remove random sample
+@_layout_cache
+def _get_cached_scale(cov_key):
+    ### Factor that maps standard normals to the covariance
+    # Diagonal covariances are applied as an elementwise scale by the standard deviations,
+    # genuinely full ones fall back to a Cholesky factor
+    cov = np.reshape(cov_key, (2, 2))
+    if cov[0, 1] == 0 and cov[1, 0] == 0:
+        return np.sqrt(np.diagonal(cov))
+
+    return np.linalg.cholesky(cov)
+
+def _get_scale(cov):
+    return _get_cached_scale(tuple(np.asarray(cov, dtype=np.float64).ravel()))
+
+def _get_generator(random_state):
+    # Build a Generator from the random state without seeding the global RNG
+    if isinstance(random_state, np.random.Generator):
+        return random_state
+    if isinstance(random_state, np.random.BitGenerator):
+        return np.random.Generator(random_state)
+
+    return np.random.Generator(np.random.PCG64(random_state)) # int, SeedSequence or None
+
+def _get_seed_sequence(random_state):
+    # Root SeedSequence and bit generator type used to spawn the per-block streams
+    if isinstance(random_state, np.random.Generator):
+        random_state = random_state.bit_generator
+    if isinstance(random_state, np.random.BitGenerator):
+        entropy = [int(x) for x in random_state.random_raw(4)] # Advances the given generator
+        return np.random.SeedSequence(entropy), type(random_state)
+    if isinstance(random_state, np.random.SeedSequence):
+        # Spawn from a copy so that the caller's SeedSequence is left unchanged and reusable
+        copy = np.random.SeedSequence(random_state.entropy, spawn_key=random_state.spawn_key, pool_size=random_state.pool_size,
+                                      n_children_spawned=random_state.n_children_spawned)
+        return copy, np.random.PCG64
+
+    return np.random.SeedSequence(random_state), np.random.PCG64 # int or None
+
+def _get_n_jobs(n_jobs):
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1) # -1 uses all processors
+    if n_jobs == 0:
+        raise ValueError("Invalid n_jobs. Must be a non-zero integer or None.")
+
+    return n_jobs
+
+def _map_blocks(func, n_blocks, n_jobs):
+    ### Run func on every block index, in a thread pool if requested
+    n_jobs = min(_get_n_jobs(n_jobs), n_blocks)
+    if n_jobs <= 1:
+        for i in range(n_blocks):
+            func(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(func, range(n_blocks))) # NumPy releases the GIL during the bulk fills
+
+def _make_block_filler(means, cov, samples_per_mode, dtype):
+    ### Precompute everything needed to fill an arbitrary row range of the dataset
+    # Cast once up front so no float64 temporaries are made for float32 output
+    means = np.asarray(means, dtype=np.float64).reshape(-1, 2).astype(dtype)
+    samples_per_mode = np.asarray(samples_per_mode, dtype=np.intp)
+    offsets = np.concatenate([[0], np.cumsum(samples_per_mode)]) # First row of each mode
+    scale = _get_scale(cov).T.astype(dtype) # Shared by every mode
+
+    def fill_block(rng, block, start):
+        stop = start + len(block)
+        rng.standard_normal(out=block, dtype=dtype) # Ziggurat normals
+        if scale.ndim == 1:
+            block *= scale
+        else:
+            block[:] = block @ scale
+        block += np.repeat(means, np.diff(np.clip(offsets, start, stop)), axis=0) # Means of the rows in this block
+
+    return fill_block
+
+def _get_alias_table(weights):
+    ### Walker's alias table for drawing modes in constant time per sample
+    modes = len(weights)
+    prob = np.asarray(weights, dtype=np.float64) * modes
+    alias = np.arange(modes)
+    small = [i for i in range(modes) if prob[i] < 1.0]
+    large = [i for i in range(modes) if prob[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] -= 1.0 - prob[s]
+        (small if prob[l] < 1.0 else large).append(l)
+    prob[small + large] = 1.0 # Leftovers are only off by rounding
+
+    return prob, alias
+
+def _check_out(out, samples):
+    # Validate a caller supplied output buffer
+    if out.shape != (samples, 2):
+        raise ValueError("Incorrect out shape. Should be [{}, 2].".format(samples))
+    if out.dtype not in (np.float32, np.float64):
+        raise ValueError("Incorrect out dtype. Should be float32 or float64.")
+    if not out.flags.c_contiguous:
+        raise ValueError("Incorrect out memory layout. Should be C-contiguous.")
+
+def _get_dtype(dtype, out=None):
+    # Resolve the output dtype from the dtype argument and output buffer
+    if dtype is None:
+        return np.float64 if out is None else out.dtype.type
+
+    dtype = np.dtype(dtype).type
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("Incorrect dtype. Should be float32 or float64.")
+    if out is not None and out.dtype != dtype:
+        raise ValueError("Incorrect out dtype. Should match dtype.")
+
+    return dtype
+
+def _make_spiral_filler(revolutions, scale, cov, arc_length, dtype):
+    ### Sample directly along a continuous spiral instead of around discrete modes
+    theta_max = 2*revolutions*np.pi
+    a = scale/2 # Radius grows by a per radian
+    noise = _get_scale(cov).T.astype(dtype)
+
+    def fill_block(rng, block, start):
+        u = rng.random(len(block))
+        if arc_length and a > 0:
+            theta = _invert_spiral_arc_length(u*_spiral_arc_length(theta_max, a), a)
+        else:
+            theta = theta_max*np.sqrt(u) # Same law as the discrete modes
+        r = a*theta
+
+        rng.standard_normal(out=block, dtype=dtype)
+        if noise.ndim == 1:
+            block *= noise
+        else:
+            block[:] = block @ noise
+        block[:, 0] += r*np.cos(theta)
+        block[:, 1] += r*np.sin(theta)
+
+    return fill_block
+
+def _spiral_arc_length(theta, a):
+    # Arc length of r = a*theta from the centre
+    return (a/2)*(theta*np.sqrt(1 + theta**2) + np.arcsinh(theta))
+
+def _invert_spiral_arc_length(length, a, iterations=8):
+    ### Solve _spiral_arc_length(theta) = length with Newton's method
+    # The arc length is convex in theta and the initial guess is an upper bound,
+    # so the iterates decrease monotonically onto the root
+    theta = np.sqrt(2*length/a)
+    for _ in range(iterations):
+        theta -= (_spiral_arc_length(theta, a) - length) / (a*np.sqrt(1 + theta**2))
+
+    return theta
+
+def _get_output(out, output_path, samples, dtype):
+    # Open the .npy file the samples are written into when an output path is given
+    if output_path is None:
+        return out
+    if out is not None:
+        raise ValueError("Only one of out and output_path can be given.")
+
+    return np.lib.format.open_memmap(output_path, mode="w+", dtype=_get_dtype(dtype), shape=(samples, 2))
+
+def _sample_blocks(fill_block, samples, random_state, n_jobs=1, out=None, dtype=np.float64, output_path=None):
+    seed_seq, bit_generator = _get_seed_sequence(random_state)
+
+    ### Fill the output in fixed size blocks, each with its own spawned stream
+    # Block boundaries do not depend on n_jobs so the output is identical for any number of workers
+    n_blocks = max(-(-samples // _BLOCK_SIZE), 1)
+    seeds = seed_seq.spawn(n_blocks)
+    if out is not None:
+        _check_out(out, samples)
+    # The output file is only created once every argument has been validated
+    data = _get_output(out, output_path, samples, dtype)
+    if data is None:
+        data = np.empty((samples, 2), dtype=dtype)
+
+    def fill(i):
+        start = i*_BLOCK_SIZE
+        rng = np.random.Generator(bit_generator(seeds[i]))
+        fill_block(rng, data[start:start+_BLOCK_SIZE], start)
+
+    try:
+        _map_blocks(fill, n_blocks, n_jobs)
+    except BaseException:
+        if output_path is not None:
+            os.remove(output_path) # Remove the partly written output file
+        raise
+    if isinstance(data, np.memmap):
+        data.flush()
+
+    return data
+
+def _sample(means, cov, samples_per_mode, random_state, n_jobs=1, out=None, dtype=None, output_path=None):
+    dtype = _get_dtype(dtype, out)
+    fill_block = _make_block_filler(means, cov, samples_per_mode, dtype)
+
+    return _sample_blocks(fill_block, int(np.sum(samples_per_mode)), random_state, n_jobs, out, dtype, output_path)
+
+def _get_labels(samples_per_mode, start=0, stop=None):
+    # Mode index of each sample in rows [start, stop), which are ordered by mode
+    offsets = np.concatenate([[0], np.cumsum(samples_per_mode)])
+    counts = np.diff(np.clip(offsets, start, offsets[-1] if stop is None else stop))
+
+    return np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+
+def _iter_sample_blocks(fill_block, samples, random_state, chunk_size, dtype=np.float64):
+    seed_seq, bit_generator = _get_seed_sequence(random_state)
+
+    ### Generate the same seeded blocks as _sample_blocks one at a time
+    # Spawning one child per block in order gives the same streams as spawning them all at once
+    def iter_blocks():
+        for start in range(0, samples, _BLOCK_SIZE):
+            block = np.empty((min(_BLOCK_SIZE, samples - start), 2), dtype=dtype)
+            rng = np.random.Generator(bit_generator(seed_seq.spawn(1)[0]))
+            fill_block(rng, block, start)
+            yield block
+
+    ### Regroup the blocks into chunks of the requested size
+    blocks = iter_blocks()
+    block, pos = np.empty((0, 2), dtype=dtype), 0
+    for chunk_start in range(0, samples, chunk_size):
+        chunk = np.empty((min(chunk_size, samples - chunk_start), 2), dtype=dtype)
+        filled = 0
+        while filled < len(chunk):
+            if pos == len(block):
+                block, pos = next(blocks), 0
+            n = min(len(chunk) - filled, len(block) - pos)
+            chunk[filled:filled+n] = block[pos:pos+n]
+            filled += n
+            pos += n
+        yield chunk
+
+def _iter_sample(means, cov, samples_per_mode, random_state, chunk_size, dtype=None, return_labels=False):
+    dtype = _get_dtype(dtype)
+    fill_block = _make_block_filler(means, cov, samples_per_mode, dtype)
+    chunks = _iter_sample_blocks(fill_block, int(np.sum(samples_per_mode)), random_state, chunk_size, dtype)
+
+    chunk_start = 0
+    for chunk in chunks:
+        if return_labels:
+            yield chunk, _get_labels(samples_per_mode, chunk_start, chunk_start + len(chunk))
+        else:
+            yield chunk
+        chunk_start += len(chunk)
+
+####################
+### Mode Layouts ###
+####################
+
+def _grid_layout(rows, cols, grid_width, grid_height, variance, sample_weights):
+    # Input exceptions
+    if rows<2:
+        raise ValueError("Invalid number of rows. Rows must be >1.")
+    if cols<2:
+        raise ValueError("Invalid number of cols. Cols must be >1.")
+    if type(variance) is list and len(variance) != 2:
+        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
+    if sample_weights and len(sample_weights) != rows*cols:
+        raise ValueError("Incorrect number of sample weights. Should be list of length 'rows*cols'")
+
+    means = _grid_means(rows, cols, grid_width, grid_height)
+
+    return means, _get_covariance(variance), sample_weights
+
+@_layout_cache
+def _grid_means(rows, cols, grid_width, grid_height):
+    # Calculate grid means
+    x_min = 0 - grid_width/2
+    x_max = 0 + grid_width/2
+    y_min = 0 - grid_height/2
+    y_max = 0 + grid_height/2
+    x_step = grid_width / (cols-1) 
+    y_step = grid_height / (rows-1) 
+
+    means = np.mgrid[x_min:(x_max+0.1):x_step, y_min:(y_max+0.1):y_step].reshape(2,-1).T
+    means = means[np.lexsort((-means[:,1], means[:,0]))] # Column-row order from the top-left
+
+    return means
+
+def _circle_layout(modes, radius, variance, sample_weights):
+    # Input exceptions
+    if type(variance) is list and len(variance) != 2:
+        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
+    if sample_weights and len(sample_weights) != modes:
+        raise ValueError("Incorrect number of sample weights. Should be list of length 'modes'")
+
+    means = _circle_means(modes, radius)
+
+    return means, _get_covariance(variance), sample_weights
+
+@_layout_cache
+def _circle_means(modes, radius):
+    # Calculate circle means
+    theta = (np.pi*2) / modes
+    angles = theta*np.arange(1, modes+1)
+    means = radius*np.column_stack([np.cos(angles), np.sin(angles)])
+
+    return means
+
+def _spiral_layout(revolutions, scale, variance, pts):
+    # Input exceptions
+    if type(variance) is list and len(variance) != 2:
+        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
+    if pts<1:
+        raise ValueError("Invalid number of points. Pts must be >0.")
+
+    means = _spiral_means(revolutions, scale, pts)
+
+    return means, _get_covariance(variance), None
+
+@_layout_cache
+def _spiral_means(revolutions, scale, pts):
+    # Calculate spiral means
+    ls = np.linspace(0,1,pts+1)[1:] # Remove ls[0]=0
+    theta = 2*revolutions*np.pi*np.sqrt(ls)
+    r = (scale/2)*theta 
+    means = np.column_stack([r*np.cos(theta), r*np.sin(theta)])
+
+    return means
+
+##################
+### Disk Cache ###
+##################
+
+class _DiskCache:
+    # Directory of generated datasets stored as .npy files named by their parameter hash
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
 
-    return np.array(data)
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path) # Mark as recently used
+
+        return data
+
+    def store(self, key, data):
+        ### Write atomically so concurrent jobs never read a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict(keep=self._path(key))
+
+    def _evict(self, keep=None):
+        ### Remove the least recently used files other than keep until the directory fits the size budget
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy") and entry.path != keep:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Already evicted by another process
+            total -= size
+
+_disk_cache = None
+
+def enable_disk_cache(directory, max_bytes=10*2**30):
+    """ Cache generated datasets on disk.
+
+    Calls of the dataset functions with an integer random_state and no out array or output_path
+    are stored as .npy files keyed by a hash of all their parameters and the library version. Every such
+    call, including the first, returns a read-only np.memmap of the stored file, and repeated calls
+    return it instead of sampling again. Copy the data to modify it in place.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to store the datasets in. Created if it does not exist.
+
+    max_bytes : int, optional (default=10*2**30)
+        The size budget of the directory. The least recently used datasets are removed once
+        it is exceeded, except the one just stored.
+    """
+
+    global _disk_cache
+    if max_bytes<0:
+        raise ValueError("Invalid cache size. Must be >=0.")
+    _disk_cache = _DiskCache(directory, max_bytes)
+
+def disable_disk_cache():
+    """ Stop caching generated datasets on disk. Stored files are left in place. """
+
+    global _disk_cache
+    _disk_cache = None
+
+def _get_cache_key(dataset, args):
+    # Hash of every parameter that affects the data points
+    params = {k: v for k, v in args.items() if k not in ("n_jobs", "out", "return_labels", "output_path")}
+    params["dtype"] = np.dtype(_get_dtype(params["dtype"])).name
+    params["random_state"] = int(params["random_state"])
+    params = json.dumps([__version__, dataset.__name__, params], sort_keys=True, default=str)
+
+    return hashlib.sha256(params.encode()).hexdigest()
+
+def _disk_cached(dataset):
+    ### Serve a dataset function's output from the disk cache when it is enabled
+    @functools.wraps(dataset)
+    def wrapper(*args, **kwargs):
+        cache = _disk_cache
+        if cache is None:
+            return dataset(*args, **kwargs)
+
+        bound = inspect.signature(dataset).bind(*args, **kwargs)
+        bound.apply_defaults()
+        args = bound.arguments
+        if args["out"] is not None or args["output_path"] is not None or not isinstance(args["random_state"], (int, np.integer)):
+            return dataset(**args) # Only reproducible calls that allocate their output are cached
+
+        if args["return_labels"] and args.get("continuous"):
+            raise ValueError("Labels are not defined for a continuous spiral. Set return_labels=False.")
+
+        key = _get_cache_key(dataset, args)
+        data = cache.load(key)
+        if data is None:
+            data = dataset(**dict(args, return_labels=False))
+            cache.store(key, data)
+            stored = cache.load(key) # Return the stored file so that misses match hits
+            if stored is None:
+                data.setflags(write=False) # Removed by another process in the meantime
+            else:
+                data = stored
+
+        if args["return_labels"]:
+            _, means, _, sample_weights = _get_layout(wrapper, args)
+            return data, _get_labels(_get_samples_per_mode(args["samples"], len(means), sample_weights))
+        return data
+
+    return wrapper
 
 ##########################
 ### Synthetic Datasets ###
 ##########################
 
-def GridGaussianDataset(rows=5, cols=5, grid_width=10, grid_height=10, variance=0.0025, samples=10000, sample_weights=None, random_state=None):
+@_disk_cached
+def GridGaussianDataset(rows=5, cols=5, grid_width=10, grid_height=10, variance=0.0025, samples=10000, sample_weights=None, random_state=None, n_jobs=1, out=None, dtype=None, return_labels=False, output_path=None):
     """ Generate a Gaussian Grid dataset.
 
     Parameters
@@ -64,6 +618,7 @@ def GridGaussianDataset(rows=5, cols=5, grid_width=10, grid_height=10, variance=
         The variance of the gaussian distribution.
         If given a single float then both the x and y variance will use that value.
         If given a list of floats then the x and y variance will use the first and second values respectively. 
+        If given a 2x2 nested list of floats then it is used as the full covariance matrix.
     
     samples : int, optional (default=10000)
         The total number of samples produced.
@@ -72,46 +627,57 @@ def GridGaussianDataset(rows=5, cols=5, grid_width=10, grid_height=10, variance=
         The proportion of samples drawn from each gaussian in column-row order (starting with top-left distribution).
         If None then all distributions receive equal weighting. 
 
-    random_state : int or None, optional (default=None)
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=None)
         Determines the RNG for the data sampling. Use for reproducible outputs.
+        Ints and SeedSequences seed a new PCG64 generator. Pass a Generator or BitGenerator
+        to choose another bit generator, ie. np.random.Generator(np.random.Philox(0)).
+        The global numpy RNG is never modified.
         If None then output is random each function call.
 
+    n_jobs : int or None, optional (default=1)
+        The number of threads used to fill the output. -1 uses all processors.
+        The output for a given random_state is identical for any value of n_jobs.
+
+    out : array of shape [samples, 2] or None, optional (default=None)
+        A C-contiguous float32 or float64 array to write the data points into.
+        If None then a new array is allocated.
+
+    dtype : float32, float64 or None, optional (default=None)
+        The floating point type of the data points. The normals are drawn directly in this type.
+        If None then float64 is used, or the dtype of out if given.
+
+    return_labels : bool, optional (default=False)
+        If True then also return the index of the gaussian each data point was drawn from.
+
+    output_path : str or None, optional (default=None)
+        A .npy file to write the data points into block by block. The data is returned as a
+        np.memmap of the file, so datasets larger than memory can be generated. The file is only
+        created once the arguments are validated and is removed if sampling fails.
+        Cannot be used with out.
+
     Returns
     -------
     data : array of shape [samples, 2]
         The data points.
-    """
-
-    # Input exceptions
-    if rows<2:
-        raise ValueError("Invalid number of rows. Rows must be >1.")
-    if cols<2:
-        raise ValueError("Invalid number of cols. Cols must be >1.")
-    if type(variance) is list and len(variance) != 2:
-        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
-    if sample_weights and len(sample_weights) != rows*cols:
-        raise ValueError("Incorrect number of sample weights. Should be list of length 'rows*cols'")
 
-    # Calculate grid means
-    x_min = 0 - grid_width/2
-    x_max = 0 + grid_width/2
-    y_min = 0 - grid_height/2
-    y_max = 0 + grid_height/2
-    x_step = grid_width / (cols-1) 
-    y_step = grid_height / (rows-1) 
+    labels : int32 array of shape [samples]
+        The gaussian index of each data point, in the same order as sample_weights.
+        Only returned if return_labels is True.
+    """
 
-    means = np.mgrid[x_min:(x_max+0.1):x_step, y_min:(y_max+0.1):y_step].reshape(2,-1).T
-    means = sorted(means, key=lambda x: (x[0], -x[1]), reverse=False)
+    means, cov, sample_weights = _grid_layout(rows, cols, grid_width, grid_height, variance, sample_weights)
 
     # Sample at each mode
-    samples_per_mode = _get_samples_per_mode(samples, rows*cols, sample_weights)
-    cov = _get_covariance(variance)
-    data = _sample(samples, means, cov, samples_per_mode, random_state) 
+    samples_per_mode = _get_samples_per_mode(samples, len(means), sample_weights)
+    data = _sample(means, cov, samples_per_mode, random_state, n_jobs, out, dtype, output_path)
 
+    if return_labels:
+        return data, _get_labels(samples_per_mode)
     return data
 
 
-def CircularGaussianDataSet(modes=8, radius=5, variance=0.0025, samples=10000, sample_weights=None, random_state=None):
+@_disk_cached
+def CircularGaussianDataSet(modes=8, radius=5, variance=0.0025, samples=10000, sample_weights=None, random_state=None, n_jobs=1, out=None, dtype=None, return_labels=False, output_path=None):
     """ Generate a Circular Gaussian dataset.
 
     Parameters
@@ -126,6 +692,7 @@ def CircularGaussianDataSet(modes=8, radius=5, variance=0.0025, samples=10000, s
         The variance of the gaussian distribution.
         If given a single float then both the x and y variance will use that value.
         If given a list of floats then the x and y variance will use the first and second values respectively. 
+        If given a 2x2 nested list of floats then it is used as the full covariance matrix.
     
     samples : int, optional (default=10000)
         The total number of samples produced.
@@ -134,39 +701,56 @@ def CircularGaussianDataSet(modes=8, radius=5, variance=0.0025, samples=10000, s
         The proportion of samples drawn from each gaussian in counter-clockwise order (starting with the north-most distribution).
         If None then all distributions receive equal weighting. 
 
-    random_state : int or None, optional (default=None)
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=None)
         Determines the RNG for the data sampling. Use for reproducible outputs.
+        Ints and SeedSequences seed a new PCG64 generator. Pass a Generator or BitGenerator
+        to choose another bit generator, ie. np.random.Generator(np.random.Philox(0)).
+        The global numpy RNG is never modified.
         If None then output is random each function call.
 
+    n_jobs : int or None, optional (default=1)
+        The number of threads used to fill the output. -1 uses all processors.
+        The output for a given random_state is identical for any value of n_jobs.
+
+    out : array of shape [samples, 2] or None, optional (default=None)
+        A C-contiguous float32 or float64 array to write the data points into.
+        If None then a new array is allocated.
+
+    dtype : float32, float64 or None, optional (default=None)
+        The floating point type of the data points. The normals are drawn directly in this type.
+        If None then float64 is used, or the dtype of out if given.
+
+    return_labels : bool, optional (default=False)
+        If True then also return the index of the gaussian each data point was drawn from.
+
+    output_path : str or None, optional (default=None)
+        A .npy file to write the data points into block by block. The data is returned as a
+        np.memmap of the file, so datasets larger than memory can be generated. The file is only
+        created once the arguments are validated and is removed if sampling fails.
+        Cannot be used with out.
+
     Returns
     -------
     data : array of shape [samples, 2]
         The data points.
-    """
 
-    # Input exceptions
-    if type(variance) is list and len(variance) != 2:
-        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
-    if sample_weights and len(sample_weights) != modes:
-        raise ValueError("Incorrect number of sample weights. Should be list of length 'modes'")
+    labels : int32 array of shape [samples]
+        The gaussian index of each data point, in the same order as sample_weights.
+        Only returned if return_labels is True.
+    """
 
-    # Calculate circle means
-    means = []
-    theta = (np.pi*2) / modes
-    for i in range(modes):
-        angle = theta*(i+1)
-        x = radius*np.cos(angle)
-        y = radius*np.sin(angle)
-        means.append([x,y])
+    means, cov, sample_weights = _circle_layout(modes, radius, variance, sample_weights)
 
     # Sample at each mode
-    samples_per_mode = _get_samples_per_mode(samples, modes, sample_weights)
-    cov = _get_covariance(variance)
-    data = _sample(samples, means, cov, samples_per_mode, random_state)
+    samples_per_mode = _get_samples_per_mode(samples, len(means), sample_weights)
+    data = _sample(means, cov, samples_per_mode, random_state, n_jobs, out, dtype, output_path)
 
+    if return_labels:
+        return data, _get_labels(samples_per_mode)
     return data
 
-def ArchimedeanSpiralDataSet(revolutions=2, scale=1, variance=0.0025, samples=10000, random_state=None):
+@_disk_cached
+def ArchimedeanSpiralDataSet(revolutions=2, scale=1, variance=0.0025, samples=10000, random_state=None, n_jobs=1, out=None, dtype=None, return_labels=False, pts=2000, continuous=False, arc_length=False, output_path=None):
     """ Generate a Archimedean Spiral dataset.
 
     Parameters
@@ -181,38 +765,1712 @@ def ArchimedeanSpiralDataSet(revolutions=2, scale=1, variance=0.0025, samples=10
         The variance of the gaussian distribution.
         If given a single float then both the x and y variance will use that value.
         If given a list of floats then the x and y variance will use the first and second values respectively. 
+        If given a 2x2 nested list of floats then it is used as the full covariance matrix.
     
     samples : int, optional (default=10000)
         The total number of samples produced.
 
-    random_state : int or None, optional (default=None)
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=None)
         Determines the RNG for the data sampling. Use for reproducible outputs.
+        Ints and SeedSequences seed a new PCG64 generator. Pass a Generator or BitGenerator
+        to choose another bit generator, ie. np.random.Generator(np.random.Philox(0)).
+        The global numpy RNG is never modified.
         If None then output is random each function call.
 
+    n_jobs : int or None, optional (default=1)
+        The number of threads used to fill the output. -1 uses all processors.
+        The output for a given random_state is identical for any value of n_jobs.
+
+    out : array of shape [samples, 2] or None, optional (default=None)
+        A C-contiguous float32 or float64 array to write the data points into.
+        If None then a new array is allocated.
+
+    dtype : float32, float64 or None, optional (default=None)
+        The floating point type of the data points. The normals are drawn directly in this type.
+        If None then float64 is used, or the dtype of out if given.
+
+    return_labels : bool, optional (default=False)
+        If True then also return the index of the gaussian each data point was drawn from.
+
+    pts : int, optional (default=2000)
+        The number of gaussians placed along the spiral.
+
+    continuous : bool, optional (default=False)
+        If True then sample positions along the continuous spiral curve, with the same
+        sqrt-distributed law as the gaussian placement, and add gaussian noise to them
+        instead of sampling from pts discrete gaussians. Cannot be used with return_labels.
+
+    arc_length : bool, optional (default=False)
+        If True then continuous samples are spread uniformly by arc length along the spiral.
+
+    output_path : str or None, optional (default=None)
+        A .npy file to write the data points into block by block. The data is returned as a
+        np.memmap of the file, so datasets larger than memory can be generated. The file is only
+        created once the arguments are validated and is removed if sampling fails.
+        Cannot be used with out.
+
     Returns
     -------
     data : array of shape [samples, 2]
         The data points.
+
+    labels : int32 array of shape [samples]
+        The gaussian index of each data point, counting outwards from the centre of the spiral.
+        Only returned if return_labels is True.
     """
 
-    # Input exceptions
-    if type(variance) is list and len(variance) != 2:
-        raise ValueError("Incorrect variance length. Should be a single scalar or list of length 2.")
+    if continuous and return_labels:
+        raise ValueError("Labels are not defined for a continuous spiral. Set return_labels=False.")
+    means, cov, _ = _spiral_layout(revolutions, scale, variance, pts)
 
-    # Calculate spiral means
-    means = []
-    pts = 2000
-    ls = np.linspace(0,1,pts+1)
-    ls = np.delete(ls, 0) # Remove ls[0]=0
-    for i in ls:
-        theta = 2*revolutions*np.pi*np.sqrt(i)
-        r = (scale/2)*theta 
-        x = r*np.cos(theta)
-        y = r*np.sin(theta)
-        means.append([x,y])
-
-    samples_per_mode = _get_samples_per_mode(samples, pts, None)
-    cov = _get_covariance(variance)
-    data = _sample(samples, means, cov, samples_per_mode, random_state)
+    if continuous:
+        dtype = _get_dtype(dtype, out)
+        fill_block = _make_spiral_filler(revolutions, scale, cov, arc_length, dtype)
+        return _sample_blocks(fill_block, samples, random_state, n_jobs, out, dtype, output_path)
 
+    # Sample at each mode
+    samples_per_mode = _get_samples_per_mode(samples, len(means), None)
+    data = _sample(means, cov, samples_per_mode, random_state, n_jobs, out, dtype, output_path)
+
+    if return_labels:
+        return data, _get_labels(samples_per_mode)
     return data
+
+_LAYOUTS = {
+    GridGaussianDataset: _grid_layout,
+    CircularGaussianDataSet: _circle_layout,
+    ArchimedeanSpiralDataSet: _spiral_layout,
+}
+
+def _bind_args(dataset, kwargs):
+    # Resolve a dataset function's arguments, including its defaults
+    if dataset not in _LAYOUTS:
+        raise ValueError("Unknown dataset. Should be GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.")
+
+    args = inspect.signature(dataset).bind(**kwargs)
+    args.apply_defaults()
+
+    return args.arguments
+
+def _get_layout(dataset, kwargs):
+    ### Resolve a dataset function's arguments and build its mode layout
+    args = _bind_args(dataset, kwargs)
+    layout = _LAYOUTS[dataset]
+    means, cov, sample_weights = layout(**{k: args[k] for k in inspect.signature(layout).parameters})
+
+    return args, means, cov, sample_weights
+
+#################
+### Streaming ###
+#################
+
+def iter_chunks(dataset, chunk_size=65536, **kwargs):
+    """ Generate a dataset in chunks without materialising it.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    chunk_size : int, optional (default=65536)
+        The number of samples in each chunk. The final chunk holds the remainder.
+
+    **kwargs
+        Arguments of the dataset function, ie. samples, random_state or the mode layout.
+        n_jobs, out and output_path are ignored as the chunks are generated sequentially.
+
+    Yields
+    ------
+    chunk : array of shape [chunk_size, 2]
+        The next data points. For a given random_state the concatenated chunks are identical
+        to the output of the dataset function, so the mode proportions match exactly.
+
+    labels : int32 array of shape [chunk_size]
+        The gaussian index of each data point in the chunk. Only yielded if return_labels is True.
+    """
+
+    if chunk_size<1:
+        raise ValueError("Invalid chunk size. Must be >0.")
+
+    args, means, cov, sample_weights = _get_layout(dataset, kwargs)
+
+    if args.get("continuous"):
+        if args["return_labels"]:
+            raise ValueError("Labels are not defined for a continuous spiral. Set return_labels=False.")
+        dtype = _get_dtype(args["dtype"])
+        fill_block = _make_spiral_filler(args["revolutions"], args["scale"], cov, args["arc_length"], dtype)
+        return _iter_sample_blocks(fill_block, args["samples"], args["random_state"], chunk_size, dtype)
+
+    samples_per_mode = _get_samples_per_mode(args["samples"], len(means), sample_weights)
+
+    return _iter_sample(means, cov, samples_per_mode, args["random_state"], chunk_size, args["dtype"], args["return_labels"])
+
+################
+### Samplers ###
+################
+
+class DatasetSampler:
+    """ Infinite minibatch sampler for a fixed dataset configuration.
+
+    The mode layout, covariance scaling and RNG are built once so that each batch only costs
+    the random number generation. Samples are drawn i.i.d. from the gaussian mixture, with
+    each mode chosen in proportion to its sample weight.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    batch_size : int, optional (default=256)
+        The number of samples returned by each iteration step.
+
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=None)
+        Determines the RNG for the data sampling. Use for reproducible outputs.
+
+    dtype : float32 or float64, optional (default=float64)
+        The floating point type of batches allocated by the sampler.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+        samples and n_jobs are ignored.
+
+    Attributes
+    ----------
+    means : array of shape [modes, 2]
+        The mean of each gaussian.
+
+    cov : array of shape [2, 2]
+        The covariance matrix shared by every gaussian.
+
+    weights : array of shape [modes]
+        The probability of drawing from each gaussian.
+    """
+
+    def __init__(self, dataset, batch_size=256, random_state=None, dtype=np.float64, **kwargs):
+        if batch_size<1:
+            raise ValueError("Invalid batch size. Must be >0.")
+
+        if kwargs.get("continuous"):
+            raise ValueError("DatasetSampler draws from the gaussian modes. Use iter_chunks for a continuous spiral.")
+
+        _, means, cov, sample_weights = _get_layout(dataset, kwargs)
+        self.means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+        self.cov = cov
+        self.weights = _get_weights(len(self.means), sample_weights)
+        self.batch_size = batch_size
+        self.dtype = _get_dtype(dtype)
+
+        self._scale = _get_scale(cov)
+        self._prob, self._alias = _get_alias_table(self.weights)
+        self._rng = _get_generator(random_state)
+        self._workspace = {}
+        self._densities = {}
+
+    def _get_workspace(self, batch_size, dtype):
+        ### Reuse the scratch buffers of the last batch of this dtype
+        ws = self._workspace.get(dtype)
+        if ws is None or len(ws["labels"]) != batch_size:
+            ws = {
+                "uniform": np.empty(batch_size),
+                "labels": np.empty(batch_size, dtype=np.intp),
+                "alias": np.empty(batch_size, dtype=np.intp),
+                "prob": np.empty(batch_size),
+                "reject": np.empty(batch_size, dtype=bool),
+                "points": np.empty((batch_size, 2), dtype=dtype),
+                "means": self.means.astype(dtype),
+                "scale": self._scale.T.astype(dtype),
+            }
+            self._workspace[dtype] = ws
+
+        return ws
+
+    def sample(self, batch_size=None, out=None, return_labels=False):
+        """ Draw a batch of samples.
+
+        Parameters
+        ----------
+        batch_size : int or None, optional (default=None)
+            The number of samples. If None then the length of out or the sampler's batch_size is used.
+
+        out : array of shape [batch_size, 2] or None, optional (default=None)
+            A C-contiguous float32 or float64 array to write the data points into.
+            Repeated calls with the same batch size and dtype allocate no new arrays.
+            If None then a new array of the sampler's dtype is allocated.
+
+        return_labels : bool, optional (default=False)
+            If True then also return the index of the gaussian each data point was drawn from.
+
+        Returns
+        -------
+        data : array of shape [batch_size, 2]
+            The data points.
+
+        labels : int32 array of shape [batch_size]
+            The gaussian index of each data point. Only returned if return_labels is True.
+        """
+
+        if batch_size is None:
+            batch_size = self.batch_size if out is None else len(out)
+        if out is None:
+            out = np.empty((batch_size, 2), dtype=self.dtype)
+        else:
+            _check_out(out, batch_size)
+
+        ws = self._get_workspace(batch_size, out.dtype.type)
+        uniform, labels = ws["uniform"], ws["labels"]
+
+        ### Choose each sample's mode with the alias method
+        self._rng.random(out=uniform)
+        uniform *= len(self.means)
+        np.modf(uniform, out=(uniform, ws["prob"])) # Split into the column and position within it
+        np.copyto(labels, ws["prob"], casting="unsafe")
+        np.minimum(labels, len(self.means) - 1, out=labels)
+        np.take(self._prob, labels, out=ws["prob"], mode="clip")
+        np.greater_equal(uniform, ws["prob"], out=ws["reject"])
+        np.take(self._alias, labels, out=ws["alias"], mode="clip")
+        np.copyto(labels, ws["alias"], where=ws["reject"])
+
+        ### Scale the normals and shift them to their mode's mean
+        self._rng.standard_normal(out=ws["points"], dtype=out.dtype)
+        if self._scale.ndim == 1:
+            np.multiply(ws["points"], ws["scale"], out=out)
+        else:
+            np.matmul(ws["points"], ws["scale"], out=out)
+        np.take(ws["means"], labels, axis=0, out=ws["points"], mode="clip")
+        out += ws["points"]
+
+        if return_labels:
+            return out, labels.astype(np.int32)
+        return out
+
+    def log_prob(self, points, truncate=None, block_size=None):
+        """ Log-density of points under the sampler's gaussian mixture.
+
+        Parameters
+        ----------
+        points : array of shape [n, 2]
+            The data points.
+
+        truncate : float or None, optional (default=None)
+            If set, the number of standard deviations beyond the nearest mode at which modes
+            are ignored. If None then every mode is evaluated and the result is exact.
+
+        block_size : int or None, optional (default=None)
+            The number of points processed at once. See log_prob.
+
+        Returns
+        -------
+        log_prob : array of shape [n]
+            The log-density of each point.
+        """
+
+        ### Reuse the whitened means and cell index of earlier calls
+        density = self._densities.get(truncate)
+        if density is None:
+            density = self._densities[truncate] = _MixtureDensity(self.means, self.cov, self.weights, truncate)
+
+        return density(points, block_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.sample()
+
+#####################
+### Shared Memory ###
+#####################
+
+SharedArrayInfo = namedtuple("SharedArrayInfo", ["name", "shape", "dtype"])
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python >= 3.13
+    except TypeError:
+        pass
+
+    ### Older versions register attached segments with the resource tracker, which then unlinks
+    # them when the attaching process exits, so undo the registration
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name != "nt": # Windows segments are not tracked
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+    return shm
+
+class SharedDataset:
+    """ Dataset held in a shared memory segment for zero-copy handoff between processes.
+
+    Create the dataset once with SharedDataset.create, pass its descriptor (or the object itself,
+    which pickles as its descriptor) to worker processes and open it there with SharedDataset.attach.
+    Use as a context manager, or call close in every process and unlink once in the creator.
+
+    Attributes
+    ----------
+    data : array of shape [samples, 2]
+        The data points, backed by the shared memory segment.
+
+    descriptor : SharedArrayInfo
+        Picklable named tuple of the segment name, shape and dtype.
+    """
+
+    def __init__(self, shm, shape, dtype, owner):
+        self._shm = shm
+        self._owner = owner
+        self.data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.descriptor = SharedArrayInfo(shm.name, tuple(shape), np.dtype(dtype).str)
+
+    @classmethod
+    def _allocate(cls, args):
+        ### Empty segment sized for a dataset function's bound arguments
+        if args["out"] is not None or args["output_path"] is not None or args["return_labels"]:
+            raise ValueError("out, output_path and return_labels cannot be used with shared memory.")
+
+        shape = (args["samples"], 2)
+        dtype = np.dtype(_get_dtype(args["dtype"]))
+        shm = shared_memory.SharedMemory(create=True, size=max(shape[0]*shape[1]*dtype.itemsize, 1))
+
+        return cls(shm, shape, dtype, owner=True)
+
+    @classmethod
+    def create(cls, dataset, **kwargs):
+        """ Generate a dataset directly into a new shared memory segment.
+
+        Parameters
+        ----------
+        dataset : function
+            One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+        **kwargs
+            Arguments of the dataset function. out, output_path and return_labels cannot be given.
+
+        Returns
+        -------
+        shared : SharedDataset
+            The dataset, owned by the calling process.
+        """
+
+        args = _bind_args(dataset, kwargs)
+        shared = cls._allocate(args)
+        try:
+            dataset(**dict(args, out=shared.data))
+        except BaseException:
+            shared.close()
+            shared.unlink()
+            raise
+
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Open a dataset created in another process without copying it.
+
+        Parameters
+        ----------
+        descriptor : SharedArrayInfo
+            The descriptor of the dataset.
+
+        Returns
+        -------
+        shared : SharedDataset
+            The dataset. Closing it does not remove the segment.
+        """
+
+        descriptor = SharedArrayInfo(*descriptor)
+        return cls(_attach_shared_memory(descriptor.name), descriptor.shape, descriptor.dtype, owner=False)
+
+    def close(self):
+        """ Release this process' view of the segment. The data array must not be used afterwards. """
+
+        self.data = None
+        self._shm.close()
+
+    def unlink(self):
+        """ Remove the segment once every process has closed it. Only valid in the creating process. """
+
+        if not self._owner:
+            raise ValueError("Only the creating process can unlink a shared dataset.")
+
+        ### Register again before unlinking, as a child process sharing this process' resource
+        # tracker removes the creator's registration when it attaches on older versions
+        if os.name != "nt":
+            resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self._owner:
+            self.unlink()
+
+    def __reduce__(self):
+        return (SharedDataset.attach, (self.descriptor,))
+
+########################
+### Batch Generation ###
+########################
+
+def _fill_shared(dataset, kwargs, descriptor):
+    # Worker process: generate one configuration into its preallocated segment
+    shared = SharedDataset.attach(descriptor)
+    try:
+        dataset(**dict(kwargs, out=shared.data))
+    finally:
+        shared.close()
+
+def _fill_file(dataset, kwargs, output_path):
+    # Worker process: generate one configuration into its preallocated .npy file
+    dataset(**dict(kwargs, out=np.load(output_path, mmap_mode="r+")))
+
+def generate_many(configs, n_workers=None, random_state=None, output_dir=None):
+    """ Generate many dataset configurations in parallel worker processes.
+
+    The data points are returned through shared memory segments or memory-mapped files
+    rather than pickled arrays.
+
+    Parameters
+    ----------
+    configs : list of (function, dict) tuples
+        The dataset function, one of GridGaussianDataset, CircularGaussianDataSet or
+        ArchimedeanSpiralDataSet, and its arguments for each configuration.
+        out, output_path and return_labels cannot be given.
+
+    n_workers : int or None, optional (default=None)
+        The number of worker processes. If None then the number of processors is used.
+
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=None)
+        Seeds an independent stream for every configuration that does not set its own random_state,
+        so each configuration's output only depends on random_state and its position in configs.
+
+    output_dir : str or None, optional (default=None)
+        If given then configuration i is written to <output_dir>/config_<i>.npy and returned as a
+        read-only np.memmap. The files are preallocated by the calling process and removed if any
+        configuration fails. If None then each configuration is returned as a SharedDataset.
+
+    Returns
+    -------
+    results : list of SharedDataset or np.memmap
+        The generated datasets in the order of configs. SharedDatasets are owned by the calling
+        process and must be closed and unlinked, ie. by using them as context managers.
+    """
+
+    configs = [(dataset, dict(kwargs)) for dataset, kwargs in configs]
+
+    ### Validate every configuration and give it a deterministic seed
+    seeds = _get_seed_sequence(random_state)[0].spawn(len(configs))
+    arguments = []
+    for (dataset, kwargs), seed in zip(configs, seeds):
+        args = _get_layout(dataset, kwargs)[0] # Fail early on invalid arguments
+        if args["out"] is not None or args["output_path"] is not None or args["return_labels"]:
+            raise ValueError("out, output_path and return_labels cannot be used with generate_many.")
+        if kwargs.get("random_state") is None:
+            kwargs["random_state"] = seed
+        arguments.append(args)
+
+    shared, paths = [], []
+    try:
+        ### Preallocate every output in the calling process
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            for i, args in enumerate(arguments):
+                paths.append(os.path.join(output_dir, "config_{}.npy".format(i)))
+                np.lib.format.open_memmap(paths[-1], mode="w+", dtype=_get_dtype(args["dtype"]), shape=(args["samples"], 2))
+            jobs = [(_fill_file, dataset, kwargs, path) for (dataset, kwargs), path in zip(configs, paths)]
+        else:
+            for args in arguments:
+                shared.append(SharedDataset._allocate(args))
+            jobs = [(_fill_shared, dataset, kwargs, segment.descriptor) for (dataset, kwargs), segment in zip(configs, shared)]
+
+        ### Fan the configurations out to the process pool
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(*job) for job in jobs]
+            for future in futures:
+                future.result()
+    except BaseException:
+        ### Release the outputs of a failed run, including partly written files
+        for segment in shared:
+            segment.__exit__()
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+    if output_dir is not None:
+        return [np.load(path, mmap_mode="r") for path in paths]
+    return shared
+
+##################
+### Evaluation ###
+##################
+
+ModeCoverage = namedtuple("ModeCoverage", ["modes_covered", "high_quality_fraction", "counts"])
+Divergence = namedtuple("Divergence", ["kl", "reverse_kl", "js"])
+
+def get_means(dataset, **kwargs):
+    """ The gaussian means of a dataset configuration.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, radius or pts.
+
+    Returns
+    -------
+    means : array of shape [modes, 2]
+        The mean of each gaussian, in the same order as the dataset's labels.
+    """
+
+    return np.asarray(_get_layout(dataset, kwargs)[1])
+
+def _get_block_size(block_size, modes):
+    # Samples per block so that each block's sample-mode distance matrix holds about 1M entries
+    if block_size is None:
+        return max(2**20 // modes, 1)
+    if block_size<1:
+        raise ValueError("Invalid block size. Must be >0.")
+
+    return block_size
+
+def _whiten(points, scale):
+    # Map points so that the covariance with this scale factor becomes the identity
+    if scale.ndim == 1:
+        return points / scale
+
+    return np.linalg.solve(scale, points.T).T
+
+def _nearest_modes(points, means):
+    ### Index of the nearest mean to each point by brute force
+    # |x - m|^2 = |x|^2 - 2 x.m + |m|^2, where |x|^2 does not change the argmin
+    dist = points @ (-2*means.T)
+    dist += np.einsum("ij,ij->i", means, means)
+
+    return np.argmin(dist, axis=1)
+
+def mode_coverage(samples, means, variance=0.0025, k=3, min_count=1, block_size=None, index=None):
+    """ Measure the mode coverage and sample quality of generated data.
+
+    Each sample is assigned to its nearest mean and counts as high quality if it lies within
+    k standard deviations of it, measured with the gaussian's covariance. A mode is covered if
+    at least min_count high quality samples are assigned to it.
+
+    Parameters
+    ----------
+    samples : array of shape [n, 2]
+        The generated data points.
+
+    means : array of shape [modes, 2]
+        The gaussian means of the dataset, ie. from get_means.
+
+    variance : float, list of floats of length 2 or 2x2 nested list, optional (default=0.0025)
+        The variance of the dataset's gaussians, in the same format as the dataset functions.
+
+    k : float, optional (default=3)
+        The number of standard deviations within which a sample is high quality.
+
+    min_count : int, optional (default=1)
+        The number of high quality samples a mode needs to be covered.
+
+    block_size : int or None, optional (default=None)
+        The number of samples processed at once. If None then it is chosen so that each block's
+        sample-mode distance matrix holds about 1M entries, or 65536 when an index is given.
+
+    index : ModeIndex or None, optional (default=None)
+        A nearest-mode index of the means, ie. from build_mode_index, used to assign the samples
+        in O(n) instead of comparing them with every mean.
+
+    Returns
+    -------
+    coverage : ModeCoverage
+        Named tuple of the number of modes covered, the fraction of high quality samples and the
+        number of high quality samples assigned to each mode.
+    """
+
+    samples = np.asarray(samples)
+    means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+    scale = _get_scale(_get_covariance(variance))
+    block_size = _get_block_size(block_size, len(means) if index is None else 16)
+
+    ### Assign the samples to modes block by block
+    counts = np.zeros(len(means), dtype=np.int64)
+    for start in range(0, len(samples), block_size):
+        block = np.asarray(samples[start:start+block_size], dtype=np.float64)
+        labels = _nearest_modes(block, means) if index is None else index.query(block)
+        offset = _whiten(block - means[labels], scale)
+        high_quality = np.einsum("ij,ij->i", offset, offset) <= k**2
+        counts += np.bincount(labels[high_quality], minlength=len(means))
+
+    modes_covered = int(np.count_nonzero(counts >= min_count))
+    high_quality_fraction = float(counts.sum() / len(samples)) if len(samples) else 0.0
+
+    return ModeCoverage(modes_covered, high_quality_fraction, counts)
+
+class ModeIndex:
+    """ Exact nearest-mode lookup for an arbitrary set of gaussian means.
+
+    The means are split into a balanced KD-tree, searched for all points at once level by level,
+    so building costs O(modes log^2 modes) and queries roughly O(n log modes). When the means
+    are spread evenly enough, the bounding box of the means is also split into a uniform grid of
+    cells that stores the few means that can be nearest to a point inside each cell, so a query
+    only compares each point with its cell's candidates. Points outside the box and layouts too
+    dense for the grid, ie. spirals with many points, are searched in the tree.
+    Use build_mode_index to get the specialised index of a dataset configuration.
+
+    Parameters
+    ----------
+    means : array of shape [modes, 2]
+        The gaussian means.
+
+    cells_per_mode : float, optional (default=4)
+        The number of cells in the grid relative to the number of modes.
+
+    leaf_size : int, optional (default=8)
+        The maximum number of means in each leaf of the tree.
+
+    Attributes
+    ----------
+    means : array of shape [modes, 2]
+        The gaussian means.
+    """
+
+    def __init__(self, means, cells_per_mode=4, leaf_size=8):
+        self.means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+        self._tree = _KDTree(self.means, leaf_size)
+        self._table = _CellTable.build(self.means, self._tree, cells_per_mode)
+
+    def query(self, points):
+        """ Find the nearest mean of each point.
+
+        Parameters
+        ----------
+        points : array of shape [n, 2]
+            The data points.
+
+        Returns
+        -------
+        labels : int32 array of shape [n]
+            The index of the nearest mean to each point.
+        """
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self._table is None:
+            return self._tree.nearest(points)[0].astype(np.int32)
+
+        labels = np.empty(len(points), dtype=np.int32)
+
+        ### Compare points with their cell's candidates only
+        rows, cells = self._table.locate(points)
+        for group, candidates in self._table.groups(cells):
+            offset = self.means[candidates] - points[rows[group], None, :]
+            dist = np.einsum("ijk,ijk->ij", offset, offset)
+            labels[rows[group]] = candidates[np.arange(len(candidates)), np.argmin(dist, axis=1)]
+
+        ### Search the tree for the few points outside the grid
+        outside = np.ones(len(points), dtype=bool)
+        outside[rows] = False
+        if outside.any():
+            labels[outside] = self._tree.nearest(points[outside])[0]
+
+        return labels
+
+def _box_distances(points, lo, hi):
+    # Squared distance from each point to its axis aligned box, zero inside the box
+    gap = np.maximum(lo - points, points - hi)
+    np.maximum(gap, 0, out=gap)
+
+    return np.einsum("ij,ij->i", gap, gap)
+
+def _group_starts(rows):
+    # Start of each run of equal values in a sorted array
+    return np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+
+class _KDTree:
+    # Balanced KD-tree over a set of means, searched breadth first for many points at once.
+    # Node k of a level with 2^l nodes holds the means order[k*modes // 2^l:(k + 1)*modes // 2^l]
+
+    def __init__(self, means, leaf_size=8):
+        if leaf_size<1:
+            raise ValueError("Invalid leaf size. Must be >0.")
+
+        self.means = means
+        modes = len(means)
+        self._depth = int(np.ceil(np.log2(max(modes / leaf_size, 1))))
+
+        ### Split every node at its median along the axis of largest spread, one level at a time
+        order = np.arange(modes)
+        for level in range(self._depth):
+            starts, segment = self._segments(level, modes)
+            points = means[order]
+            spread = np.maximum.reduceat(points, starts) - np.minimum.reduceat(points, starts)
+            key = points[np.arange(modes), np.argmax(spread, axis=1)[segment]]
+            order = order[np.lexsort((key, segment))]
+
+        ### Bounding boxes of the leaves, then of their ancestors
+        starts, _ = self._segments(self._depth, modes)
+        points = means[order]
+        self._lo = [np.minimum.reduceat(points, starts)]
+        self._hi = [np.maximum.reduceat(points, starts)]
+        for _ in range(self._depth):
+            self._lo.insert(0, np.minimum(self._lo[0][0::2], self._lo[0][1::2]))
+            self._hi.insert(0, np.maximum(self._hi[0][0::2], self._hi[0][1::2]))
+
+        ### A mean of every node, whose distance bounds the distance to the node's nearest mean
+        self._representatives = [means[order[self._segments(level, modes)[0]]] for level in range(self._depth + 1)]
+
+        ### Pad the leaves to a rectangular table by repeating each leaf's last mean
+        counts = np.diff(np.append(starts, modes))
+        slots = np.minimum(np.arange(counts.max()), counts[:, None] - 1)
+        self._leaves = order[starts[:, None] + slots]
+        self._padding = np.arange(counts.max()) >= counts[:, None]
+
+    @staticmethod
+    def _segments(level, modes):
+        # Start of each node of a level and the node of each position in the order
+        starts = np.arange(2**level)*modes // 2**level
+        return starts, np.repeat(np.arange(2**level), np.diff(np.append(starts, modes)))
+
+    def _expand(self, points, bound, tighten=False):
+        ### Leaves whose box lies within the squared bound of each point
+        # The (row, node) pairs stay sorted by row as each pair is replaced by its children in place.
+        # If tighten is set then the bound shrinks to the nearest representative seen at each level
+        rows = np.arange(len(points))
+        nodes = np.zeros(len(points), dtype=np.intp)
+        for level in range(1, self._depth + 1):
+            rows = np.repeat(rows, 2)
+            nodes = (2*nodes[:, None] + [0, 1]).ravel()
+            pairs = points[rows]
+            if tighten:
+                offset = self._representatives[level][nodes] - pairs
+                dist = np.einsum("ij,ij->i", offset, offset)
+                bound = np.minimum(bound, np.minimum.reduceat(dist, _group_starts(rows)))
+            keep = _box_distances(pairs, self._lo[level][nodes], self._hi[level][nodes]) <= bound[rows]
+            rows, nodes = rows[keep], nodes[keep]
+
+        return rows, nodes
+
+    def _leaf_distances(self, points, rows, leaves):
+        # Squared distance from each point to every mean of its paired leaf
+        offset = self.means[self._leaves[leaves]] - points[rows, None, :]
+        return np.einsum("ijk,ijk->ij", offset, offset)
+
+    def nearest(self, points):
+        # Index of and squared distance to the nearest mean of each point
+        if len(points) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        ### Bound the search by the nearest representative found so far while descending
+        offset = self._representatives[0][0] - points
+        rows, leaves = self._expand(points, np.einsum("ij,ij->i", offset, offset), tighten=True)
+
+        ### Search every leaf that may hold a closer mean, breaking ties by the lowest index
+        dist = self._leaf_distances(points, rows, leaves)
+        column = np.argmin(dist, axis=1)
+        dist = dist[np.arange(len(rows)), column]
+        labels = self._leaves[leaves, column]
+
+        starts = _group_starts(rows)
+        best = np.minimum.reduceat(dist, starts)
+        tied = dist == np.repeat(best, np.diff(np.append(starts, len(rows))))
+        labels = np.minimum.reduceat(np.where(tied, labels, len(self.means)), starts)
+
+        return labels, best
+
+    def within(self, points, bound):
+        # Sorted rows, mean indices and squared distances of every point-mean pair within the squared bound
+        rows, leaves = self._expand(points, bound)
+        dist = self._leaf_distances(points, rows, leaves)
+        keep = (dist <= bound[rows, None]) & ~self._padding[leaves]
+        rows = np.broadcast_to(rows[:, None], keep.shape)[keep]
+
+        return rows, self._leaves[leaves][keep], dist[keep]
+
+class _CellTable:
+    # Uniform grid of cells over a set of means, storing the means that can be nearest to a point in each cell
+
+    def __init__(self, lo, cell, shape, candidates, starts, counts):
+        self._lo, self._cell, self._shape = lo, cell, shape
+        self._candidates, self._starts, self._counts = candidates, starts, counts
+        self._widths = 2**np.ceil(np.log2(counts)).astype(np.intp)
+
+    @classmethod
+    def build(cls, means, tree, cells_per_mode=4, max_candidates=64):
+        # The table of the means, or None if the cells would average more than max_candidates candidates
+
+        ### Uniform grid of roughly square cells over the means
+        lo = means.min(axis=0)
+        extent = np.maximum(means.max(axis=0) - lo, 1e-12)
+        cell = np.sqrt(extent.prod() / max(cells_per_mode*len(means), 1))
+        cell = max(cell, extent.max() / 4096) # Bound the number of cells of degenerate layouts
+        shape = np.maximum(np.ceil(extent / cell).astype(np.intp), 1)
+        cell = extent / shape
+
+        ### Candidates of each cell
+        # For a point p within r of the cell centre c, the nearest mean m* satisfies
+        # |c - m*| <= |p - m*| + r <= |p - m_c| + r <= |c - m_c| + 2r, where m_c is the nearest mean to c
+        ix, iy = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+        centres = lo + (np.column_stack([ix.ravel(), iy.ravel()]) + 0.5)*cell
+        half_diagonal = np.hypot(*cell) / 2
+
+        def search(centres):
+            bound = np.sqrt(tree.nearest(centres)[1]) + 2*half_diagonal
+            return tree.within(centres, (bound*(1 + 1e-9))**2)
+
+        ### Estimate the table size from a sample of cells before building it
+        sample = np.random.default_rng(0).choice(len(centres), min(len(centres), 1024), replace=False)
+        if len(search(centres[sample])[0]) > max_candidates*len(sample):
+            return None
+
+        rows, labels = [], []
+        for start in range(0, len(centres), _BLOCK_SIZE):
+            block_rows, block_labels, _ = search(centres[start:start+_BLOCK_SIZE])
+            rows.append(block_rows + start)
+            labels.append(block_labels)
+        rows, labels = np.concatenate(rows), np.concatenate(labels)
+        order = np.lexsort((labels, rows)) # Ascending candidates so that ties resolve to the lowest index
+
+        counts = np.bincount(rows, minlength=len(centres))
+        starts = np.append(0, np.cumsum(counts)[:-1])
+
+        return cls(lo, cell, shape, labels[order], starts, counts)
+
+    def locate(self, points):
+        # Rows of the points inside the grid and the flat index of their cells
+        cell = np.floor((points - self._lo) / self._cell).astype(np.intp)
+        rows = np.nonzero(np.all((cell >= 0) & (cell < self._shape), axis=1))[0]
+
+        return rows, cell[rows, 0]*self._shape[1] + cell[rows, 1]
+
+    def groups(self, cells):
+        ### Positions of the cells of each width group and their candidates
+        # Cells are grouped by the power of two above their candidate count so that queries in
+        # sparse cells only scan a narrow slice, padded by repeating each cell's last candidate
+        widths = self._widths[cells]
+        for width in np.unique(widths):
+            group = np.nonzero(widths == width)[0]
+            slots = np.minimum(np.arange(width), self._counts[cells[group], None] - 1)
+            yield group, self._candidates[self._starts[cells[group], None] + slots]
+
+class _GridModeIndex(ModeIndex):
+    # Nearest mode of a rectangular grid by rounding each coordinate to the nearest grid line
+
+    def __init__(self, means):
+        self.means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+        self._xs = np.unique(self.means[:, 0])
+        self._ys = np.unique(self.means[:, 1])
+
+    def query(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        col = _nearest_grid_line(points[:, 0], self._xs)
+        row = _nearest_grid_line(points[:, 1], self._ys)
+
+        return (col*len(self._ys) + (len(self._ys) - 1 - row)).astype(np.int32) # Column-row order from the top-left
+
+class _CircleModeIndex(ModeIndex):
+    # Nearest mode of evenly spaced means on a circle by bucketing the angle of each point
+
+    def __init__(self, means):
+        self.means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+
+    def query(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        theta = (np.pi*2) / len(self.means)
+        angle = np.arctan2(points[:, 1], points[:, 0])
+
+        return ((np.rint(angle / theta).astype(np.intp) - 1) % len(self.means)).astype(np.int32) # Mode i sits at angle theta*(i+1)
+
+def _nearest_grid_line(values, lines):
+    # Index of the nearest of the evenly spaced, sorted lines
+    if len(lines) == 1:
+        return np.zeros(len(values), dtype=np.intp)
+
+    index = np.rint((values - lines[0]) / (lines[1] - lines[0]))
+    return np.clip(index, 0, len(lines) - 1).astype(np.intp)
+
+def build_mode_index(dataset, **kwargs):
+    """ Build the nearest-mode index of a dataset configuration.
+
+    Grids are indexed by rounding each coordinate, circles by bucketing the angle of each point
+    and spirals with the cell lookup and KD-tree of ModeIndex, so assignments take O(n) or
+    O(n log modes) rather than O(n*modes).
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, radius or pts.
+
+    Returns
+    -------
+    index : ModeIndex
+        The index. index.query(points) returns the nearest mode of each point.
+    """
+
+    means = get_means(dataset, **kwargs)
+    if dataset is GridGaussianDataset:
+        return _GridModeIndex(means)
+    if dataset is CircularGaussianDataSet and _bind_args(dataset, kwargs)["radius"] > 0:
+        return _CircleModeIndex(means)
+
+    return ModeIndex(means)
+
+class _MixtureDensity:
+    # Log-density of a gaussian mixture with a shared covariance, evaluated in whitened coordinates
+
+    def __init__(self, means, cov, weights, truncate=None):
+        if truncate is not None and truncate<=0:
+            raise ValueError("Invalid truncation radius. Must be >0.")
+
+        self._scale = _get_scale(cov)
+        self._means = _whiten(np.asarray(means, dtype=np.float64).reshape(-1, 2), self._scale)
+        with np.errstate(divide="ignore"):
+            self._log_weights = np.log(weights)
+
+        ### log N(x; m, LL^T) = -log(2pi) - log|det L| - |L^-1 (x - m)|^2 / 2
+        scale = self._scale if self._scale.ndim == 1 else np.diag(self._scale)
+        self._const = -np.log(2*np.pi) - np.log(scale).sum()
+        self._bias = self._log_weights - 0.5*np.einsum("ij,ij->i", self._means, self._means)
+        self._truncate = truncate
+        self._tree = None
+        if truncate is not None:
+            self._support = np.flatnonzero(weights > 0) # Modes without weight add no density
+            self._tree = _KDTree(self._means[self._support])
+
+    def __call__(self, points, block_size=None):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        log_prob = np.empty(len(points))
+        block_size = _get_block_size(block_size, len(self._means) if self._tree is None else 16)
+
+        for start in range(0, len(points), block_size):
+            block = _whiten(points[start:start+block_size], self._scale)
+            if self._tree is None:
+                log_prob[start:start+block_size] = self._exact(block)
+            else:
+                log_prob[start:start+block_size] = self._truncated(block)
+
+        log_prob += self._const
+        return log_prob
+
+    def _exact(self, points):
+        ### log sum_k w_k exp(-|x - m_k|^2 / 2) with |x - m_k|^2 = |x|^2 - 2 x.m_k + |m_k|^2
+        logits = points @ self._means.T
+        logits += self._bias
+
+        return _logsumexp(logits) - 0.5*np.einsum("ij,ij->i", points, points)
+
+    def _truncated(self, points):
+        ### Sum over the means within the radius beyond each point's nearest mean
+        # A mean further than d + R is below exp(-R^2/2) of the density of the nearest mean at d
+        bound = (np.sqrt(self._tree.nearest(points)[1]) + self._truncate)**2
+        rows, labels, dist = self._tree.within(points, bound)
+        logits = self._log_weights[self._support[labels]] - 0.5*dist
+
+        starts = _group_starts(rows)
+        counts = np.diff(np.append(starts, len(rows)))
+        peak = np.maximum.reduceat(logits, starts)
+        peak[~np.isfinite(peak)] = 0
+        logits -= np.repeat(peak, counts)
+        np.exp(logits, out=logits)
+
+        with np.errstate(divide="ignore"):
+            return np.log(np.add.reduceat(logits, starts)) + peak
+
+def _logsumexp(logits):
+    # Stable log of the row sums of exp(logits), modifying logits in place
+    peak = logits.max(axis=1)
+    peak[~np.isfinite(peak)] = 0
+    logits -= peak[:, None]
+    np.exp(logits, out=logits)
+
+    with np.errstate(divide="ignore"):
+        return np.log(logits.sum(axis=1)) + peak
+
+def log_prob(points, dataset, truncate=None, block_size=None, **kwargs):
+    """ Log-density of points under the gaussian mixture of a dataset configuration.
+
+    The density is a logsumexp over the modes, evaluated block by block so that memory stays
+    constant per block. With truncate set only the modes within truncate standard deviations of
+    each point's nearest mode are evaluated, found through a KD-tree, which keeps many-mode
+    spirals cheap.
+
+    Parameters
+    ----------
+    points : array of shape [n, 2]
+        The data points.
+
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    truncate : float or None, optional (default=None)
+        If set, the number of standard deviations, measured with the gaussian's covariance,
+        beyond the distance to a point's nearest mode at which modes are ignored. Each ignored
+        mode's density at the point is below exp(-truncate**2/2) of the nearest mode's.
+        If None then every mode is evaluated and the result is exact.
+
+    block_size : int or None, optional (default=None)
+        The number of points processed at once. If None then it is chosen so that each block's
+        point-mode matrix holds about 1M entries, or 65536 when truncate is set.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+
+    Returns
+    -------
+    log_prob : array of shape [n]
+        The log-density of each point.
+    """
+
+    if kwargs.get("continuous"):
+        raise ValueError("log_prob evaluates the gaussian mixture. A continuous spiral has no closed form density.")
+
+    _, means, cov, sample_weights = _get_layout(dataset, kwargs)
+    weights = _get_weights(len(np.asarray(means).reshape(-1, 2)), sample_weights)
+
+    return _MixtureDensity(means, cov, weights, truncate)(points, block_size)
+
+def _get_points(data):
+    # Stack an array or an iterable of chunks, ie. from iter_chunks, into a float64 array of shape [n, 2]
+    if not hasattr(data, "shape"):
+        data = np.concatenate([np.asarray(chunk, dtype=np.float64).reshape(-1, 2) for chunk in data] or [np.empty((0, 2))])
+
+    return np.asarray(data, dtype=np.float64).reshape(-1, 2)
+
+class SlicedWasserstein:
+    """ Sliced-Wasserstein distance between two sets of 2D points.
+
+    Both sets are projected onto a fixed bank of random directions and the exact 1D optimal
+    transport cost of each projection is found by sorting, so a distance costs O(n log n) per
+    direction rather than the O(n^3) of exact optimal transport. The directions are drawn once
+    so that distances from repeated calls, ie. every training step, are comparable.
+
+    Parameters
+    ----------
+    projections : int, optional (default=128)
+        The number of random directions.
+
+    p : float, optional (default=2)
+        The order of the Wasserstein distance.
+
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=0)
+        Determines the RNG for the directions.
+
+    Attributes
+    ----------
+    directions : array of shape [2, projections]
+        The unit projection directions.
+    """
+
+    def __init__(self, projections=128, p=2, random_state=0):
+        if projections<1:
+            raise ValueError("Invalid number of projections. Must be >0.")
+        if p<1:
+            raise ValueError("Invalid order. Must be >=1.")
+
+        self.p = p
+        directions = _get_generator(random_state).standard_normal((2, projections))
+        self.directions = directions / np.linalg.norm(directions, axis=0)
+
+    def distance(self, x, y, block_size=None, n_jobs=1):
+        """ Sliced-Wasserstein distance between two sets of points.
+
+        Parameters
+        ----------
+        x, y : arrays of shape [n, 2] and [m, 2], or iterables of such chunks
+            The two sets of points, ie. generated samples and a fresh draw of the dataset.
+            The sets may differ in size.
+
+        block_size : int or None, optional (default=None)
+            The number of directions projected at once. If None then it is chosen so that each
+            block's projections hold about 16M entries.
+
+        n_jobs : int or None, optional (default=1)
+            The number of threads used to sort the projections of different blocks.
+            -1 uses all processors.
+
+        Returns
+        -------
+        distance : float
+            The p-th root of the mean p-th power Wasserstein distance over the directions.
+        """
+
+        x, y = _get_points(x), _get_points(y)
+        n, m = len(x), len(y)
+        if n == 0 or m == 0:
+            raise ValueError("Both sets of points must be non-empty.")
+
+        ### Pair the quantiles of the two empirical distributions
+        # Over each interval between consecutive breakpoints i/n and j/m, both quantile functions
+        # are constant, so the 1D transport cost is a weighted sum over the merged breakpoints.
+        # Breakpoints are kept as integer multiples of 1/(n*m) to merge them exactly
+        if n == m:
+            ix = iy = None
+            widths = 1 / n
+        else:
+            breaks = np.union1d(np.arange(1, n + 1, dtype=np.int64)*m, np.arange(1, m + 1, dtype=np.int64)*n)
+            widths = np.diff(breaks, prepend=0) / (n*m)
+            ix = -(-breaks // m) - 1
+            iy = -(-breaks // n) - 1
+
+        ### Transport cost of each direction block by block
+        block_size = _get_block_size(None, n + m)*16 if block_size is None else _get_block_size(block_size, 1)
+        n_blocks = -(-self.directions.shape[1] // block_size)
+        cost = np.zeros(n_blocks)
+
+        def transport(i):
+            directions = self.directions[:, i*block_size:(i + 1)*block_size].T
+            px = directions @ x.T # One projection per row so that each sort is contiguous
+            py = directions @ y.T
+            px.sort(axis=1)
+            py.sort(axis=1)
+            if ix is not None:
+                px, py = px[:, ix], py[:, iy]
+
+            diff = np.abs(px - py, out=px)
+            cost[i] = (np.power(diff, self.p, out=diff) @ np.broadcast_to(widths, diff.shape[1])).sum()
+
+        _map_blocks(transport, n_blocks, n_jobs)
+
+        return float((cost.sum() / self.directions.shape[1])**(1 / self.p))
+
+class FourierMMD:
+    """ Streaming maximum mean discrepancy estimate with random Fourier features.
+
+    The gaussian kernel exp(-|x - y|^2 / (2 bandwidth^2)) is approximated by the inner product
+    of D random cosine features, so the squared MMD between two distributions becomes the squared
+    distance between their mean feature vectors. These means are accumulated batch by batch in
+    O(n*D) time and O(D) memory. The feature bank is drawn once from a fixed seed so that scores
+    are comparable across runs with the same parameters.
+
+    Parameters
+    ----------
+    features : int, optional (default=1024)
+        The number of random features D.
+
+    bandwidth : float, optional (default=1)
+        The length scale of the gaussian kernel.
+
+    random_state : int, SeedSequence, Generator, BitGenerator or None, optional (default=0)
+        Determines the RNG for the feature bank.
+
+    Attributes
+    ----------
+    frequencies : array of shape [2, features]
+        The random frequencies of the features.
+
+    phases : array of shape [features]
+        The random phases of the features.
+    """
+
+    def __init__(self, features=1024, bandwidth=1, random_state=0):
+        if features<1:
+            raise ValueError("Invalid number of features. Must be >0.")
+        if bandwidth<=0:
+            raise ValueError("Invalid bandwidth. Must be >0.")
+
+        rng = _get_generator(random_state)
+        self.frequencies = rng.standard_normal((2, features)) / bandwidth
+        self.phases = rng.uniform(0, 2*np.pi, features)
+        self.reset()
+
+    def reset(self):
+        """ Discard the accumulated samples and reference. """
+
+        self._sums = {"fake": np.zeros(self.phases.shape), "real": np.zeros(self.phases.shape)}
+        self._counts = {"fake": 0, "real": 0}
+        self._reference = None
+
+    def _accumulate(self, key, points, block_size):
+        points = _get_points(points)
+        block_size = _get_block_size(block_size, len(self.phases))
+
+        for start in range(0, len(points), block_size):
+            proj = points[start:start+block_size] @ self.frequencies
+            proj += self.phases
+            self._sums[key] += np.cos(proj, out=proj).sum(axis=0)
+        self._counts[key] += len(points)
+
+    def update(self, fake=None, real=None, block_size=None):
+        """ Accumulate a batch of generated and/or reference samples.
+
+        Parameters
+        ----------
+        fake : array of shape [n, 2], iterable of such chunks or None, optional (default=None)
+            Generated samples.
+
+        real : array of shape [m, 2], iterable of such chunks or None, optional (default=None)
+            Samples of the reference distribution. Ignored by score once set_reference is called.
+
+        block_size : int or None, optional (default=None)
+            The number of samples featurised at once. If None then it is chosen so that each
+            block's features hold about 1M entries.
+        """
+
+        if fake is not None:
+            self._accumulate("fake", fake, block_size)
+        if real is not None:
+            self._accumulate("real", real, block_size)
+
+    def set_reference(self, dataset, **kwargs):
+        """ Use the exact mean features of a dataset configuration's gaussian mixture as the reference.
+
+        For x ~ N(m, C), E[cos(w.x + b)] = exp(-w^T C w / 2) cos(w.m + b), so the mean features
+        of the mixture follow from its means, covariance and weights without sampling.
+
+        Parameters
+        ----------
+        dataset : function
+            One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+        **kwargs
+            Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+        """
+
+        if kwargs.get("continuous"):
+            raise ValueError("set_reference uses the gaussian mixture. Use update with samples of a continuous spiral.")
+
+        _, means, cov, sample_weights = _get_layout(dataset, kwargs)
+        means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+        weights = _get_weights(len(means), sample_weights)
+        cov = np.diag(cov) if np.ndim(cov) == 1 else np.asarray(cov)
+
+        reference = np.zeros(self.phases.shape)
+        block_size = _get_block_size(None, len(self.phases))
+        for start in range(0, len(means), block_size):
+            proj = means[start:start+block_size] @ self.frequencies
+            proj += self.phases
+            reference += weights[start:start+block_size] @ np.cos(proj, out=proj)
+
+        damping = np.exp(-0.5*np.einsum("ij,ik,kj->j", self.frequencies, cov, self.frequencies))
+        self._reference = reference*damping
+
+    def score(self):
+        """ The squared MMD estimate between the accumulated generated samples and the reference.
+
+        Returns
+        -------
+        mmd2 : float
+            The squared distance between the mean feature vectors, with the features scaled
+            so that it approximates the squared MMD of the gaussian kernel.
+        """
+
+        if self._counts["fake"] == 0:
+            raise ValueError("No generated samples have been accumulated.")
+
+        if self._reference is not None:
+            reference = self._reference
+        elif self._counts["real"]:
+            reference = self._sums["real"] / self._counts["real"]
+        else:
+            raise ValueError("No reference samples have been accumulated. Call update with real samples or set_reference.")
+
+        diff = self._sums["fake"] / self._counts["fake"] - reference
+        return float(2*np.dot(diff, diff) / len(self.phases)) # Features are sqrt(2/D) cos(w.x + b)
+
+_erf = np.vectorize(math.erf, otypes=[np.float64])
+
+def _get_bounds(means, std, margin):
+    # Bounding box of the means padded by margin standard deviations along each axis
+    return means.min(axis=0) - margin*std, means.max(axis=0) + margin*std
+
+def _normal_bin_probabilities(edges, means, std):
+    # Probability of each bin between consecutive edges under N(mean, std^2), one row per mean
+    cdf = _erf((edges[None, :] - means[:, None]) / (std*np.sqrt(2)))
+
+    return 0.5*np.diff(cdf, axis=1)
+
+def _kl(p, q):
+    # KL(p || q) of discrete distributions, where terms with p = 0 vanish
+    support = p > 0
+    return float(np.sum(p[support]*np.log(p[support] / q[support])))
+
+class HistogramDivergence:
+    """ Histogram estimates of the KL and JS divergence between generated data and a dataset.
+
+    The bounding box of the dataset's gaussians is split into a fixed grid of bins, with one extra
+    bin for everything outside it. The ground-truth probability of each bin is precomputed once,
+    exactly from the gaussian CDFs when the covariance is diagonal, since each mode's bin
+    probabilities then factor into an x and a y term, and otherwise from a fixed-seed sample of
+    reference_samples points. Generated data is binned in O(n) with np.bincount.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    bins : int, optional (default=128)
+        The number of bins along each axis.
+
+    margin : float, optional (default=4)
+        The number of standard deviations the bounding box extends beyond the outermost means.
+
+    epsilon : float, optional (default=1e-10)
+        The probability added to every bin of both histograms before comparing them, so that
+        empty bins give finite divergences.
+
+    reference_samples : int, optional (default=2**22)
+        The number of samples drawn for the ground-truth histogram when it has no closed form,
+        ie. for a full covariance or a continuous spiral.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+
+    Attributes
+    ----------
+    x_edges, y_edges : arrays of shape [bins + 1]
+        The bin edges along each axis.
+
+    probabilities : array of shape [bins*bins + 1]
+        The ground-truth probability of each bin, flattened in x-major order, followed by
+        the probability of falling outside the bounding box.
+    """
+
+    def __init__(self, dataset, bins=128, margin=4, epsilon=1e-10, reference_samples=2**22, **kwargs):
+        if bins<1:
+            raise ValueError("Invalid number of bins. Must be >0.")
+
+        self.bins = bins
+        self.epsilon = epsilon
+
+        _, means, cov, sample_weights = _get_layout(dataset, dict(kwargs))
+        means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+        std = np.sqrt(np.diag(cov))
+
+        lo, hi = _get_bounds(means, std, margin)
+        self.x_edges = np.linspace(lo[0], hi[0], bins + 1)
+        self.y_edges = np.linspace(lo[1], hi[1], bins + 1)
+
+        if kwargs.get("continuous") or cov[0, 1] != 0:
+            ### Cache the histogram of a large fixed-seed sample
+            kwargs.update(samples=reference_samples, random_state=0)
+            counts = self._count(iter_chunks(dataset, **kwargs))
+            self.probabilities = counts / reference_samples
+        else:
+            ### The mixture's bin probabilities are sum_k w_k px_k[i] py_k[j]
+            weights = _get_weights(len(means), sample_weights)
+            px = _normal_bin_probabilities(self.x_edges, means[:, 0], std[0])
+            py = _normal_bin_probabilities(self.y_edges, means[:, 1], std[1])
+            inside = (px.T*weights) @ py
+            self.probabilities = np.append(inside.ravel(), max(1 - inside.sum(), 0))
+
+    def _count(self, data, block_size=_BLOCK_SIZE):
+        # Histogram counts of an array or an iterable of chunks, block by block
+        counts = np.zeros(self.bins*self.bins + 1, dtype=np.int64)
+        chunks = [data] if hasattr(data, "shape") else data
+        scale = self.bins / np.array([self.x_edges[-1] - self.x_edges[0], self.y_edges[-1] - self.y_edges[0]])
+        lo = np.array([self.x_edges[0], self.y_edges[0]])
+
+        for chunk in chunks:
+            chunk = np.asarray(chunk).reshape(-1, 2)
+            for start in range(0, len(chunk), block_size):
+                cell = np.floor((chunk[start:start+block_size] - lo)*scale)
+                inside = np.all((cell >= 0) & (cell < self.bins), axis=1)
+                flat = np.where(inside, cell[:, 0]*self.bins + cell[:, 1], self.bins*self.bins) # Outside bin last
+                counts += np.bincount(flat.astype(np.intp), minlength=len(counts))
+
+        return counts
+
+    def divergence(self, samples):
+        """ Divergences between the histogram of generated data and the ground truth.
+
+        Parameters
+        ----------
+        samples : array of shape [n, 2] or iterable of such chunks
+            The generated data points.
+
+        Returns
+        -------
+        divergence : Divergence
+            Named tuple of KL(data || generated), the reverse KL(generated || data) and the
+            Jensen-Shannon divergence, in nats.
+        """
+
+        counts = self._count(samples)
+        if counts.sum() == 0:
+            raise ValueError("No samples were given.")
+
+        p = self.probabilities + self.epsilon
+        p /= p.sum()
+        q = counts / counts.sum() + self.epsilon
+        q /= q.sum()
+        m = 0.5*(p + q)
+
+        return Divergence(_kl(p, q), _kl(q, p), 0.5*_kl(p, m) + 0.5*_kl(q, m))
+
+class CoverageAccumulator:
+    """ Streaming mode coverage and per-mode statistics of generated data.
+
+    Batches are assigned to modes with the dataset configuration's nearest-mode index as in
+    mode_coverage, and only O(modes) running totals are kept: the number of high quality samples
+    of each mode and their mean and covariance, updated with Welford's algorithm in its batched
+    form. Accumulators of the same configuration, ie. from different worker processes, can be
+    merged and pickled.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    k : float, optional (default=3)
+        The number of standard deviations within which a sample is high quality.
+
+    min_count : int, optional (default=1)
+        The number of high quality samples a mode needs to be covered.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+
+    Attributes
+    ----------
+    means : array of shape [modes, 2]
+        The gaussian means of the dataset.
+
+    samples : int
+        The number of samples accumulated.
+
+    counts : int64 array of shape [modes]
+        The number of high quality samples assigned to each mode.
+
+    sample_mean : array of shape [modes, 2]
+        The mean of the high quality samples assigned to each mode, or zero for modes without any.
+    """
+
+    def __init__(self, dataset, k=3, min_count=1, **kwargs):
+        if kwargs.get("continuous"):
+            raise ValueError("CoverageAccumulator assigns samples to the gaussian modes. A continuous spiral has none.")
+
+        _, means, cov, _ = _get_layout(dataset, dict(kwargs))
+        self._index = build_mode_index(dataset, **kwargs)
+        self._scale = _get_scale(cov)
+        self.means = self._index.means
+        self.k = k
+        self.min_count = min_count
+
+        self.samples = 0
+        self.counts = np.zeros(len(self.means), dtype=np.int64)
+        self.sample_mean = np.zeros((len(self.means), 2))
+        self._comoment = np.zeros((len(self.means), 2, 2)) # Sum of outer products of deviations from the mean
+
+    def _combine(self, counts, mean, comoment):
+        ### Chan et al. merge of two sets of per-mode counts, means and comoments
+        total = self.counts + counts
+        ratio = np.divide(counts, total, out=np.zeros(len(total)), where=total > 0)
+        delta = mean - self.sample_mean
+        self._comoment += comoment + np.einsum("i,ij,ik->ijk", ratio*self.counts, delta, delta)
+        self.sample_mean += delta*ratio[:, None]
+        self.counts = total
+
+    def update(self, batch, block_size=_BLOCK_SIZE):
+        """ Accumulate a batch of generated samples.
+
+        Parameters
+        ----------
+        batch : array of shape [n, 2]
+            The generated data points.
+
+        block_size : int, optional (default=65536)
+            The number of samples processed at once.
+        """
+
+        batch = np.asarray(batch).reshape(-1, 2)
+        modes = len(self.means)
+
+        for start in range(0, len(batch), block_size):
+            block = np.asarray(batch[start:start+block_size], dtype=np.float64)
+            labels = self._index.query(block)
+            offset = _whiten(block - self.means[labels], self._scale)
+            high_quality = np.einsum("ij,ij->i", offset, offset) <= self.k**2
+            block, labels = block[high_quality], labels[high_quality]
+
+            ### Per-mode counts, means and comoments of the block's high quality samples
+            counts = np.bincount(labels, minlength=modes)
+            mean = np.column_stack([np.bincount(labels, block[:, i], minlength=modes) for i in range(2)])
+            mean /= np.maximum(counts, 1)[:, None]
+            deviation = block - mean[labels]
+            comoment = np.stack([
+                np.bincount(labels, deviation[:, i]*deviation[:, j], minlength=modes)
+                for i in range(2) for j in range(2)
+            ], axis=1).reshape(modes, 2, 2)
+
+            self._combine(counts, mean, comoment)
+            self.samples += len(high_quality)
+
+    def merge(self, other):
+        """ Add the totals of another accumulator of the same configuration.
+
+        Parameters
+        ----------
+        other : CoverageAccumulator
+            The accumulator to merge into this one. It is left unchanged.
+
+        Returns
+        -------
+        self : CoverageAccumulator
+        """
+
+        if self.means.shape != other.means.shape or not np.array_equal(self.means, other.means):
+            raise ValueError("Cannot merge accumulators of different dataset configurations.")
+
+        self._combine(other.counts, other.sample_mean, other._comoment)
+        self.samples += other.samples
+
+        return self
+
+    @property
+    def sample_covariance(self):
+        """ The unbiased covariance of the high quality samples of each mode, of shape [modes, 2, 2].
+        Modes with fewer than two such samples are nan. """
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._comoment / (self.counts - 1)[:, None, None]
+
+    def coverage(self):
+        """ The mode coverage of the samples accumulated so far.
+
+        Returns
+        -------
+        coverage : ModeCoverage
+            The same named tuple as mode_coverage for all the accumulated samples.
+        """
+
+        modes_covered = int(np.count_nonzero(self.counts >= self.min_count))
+        high_quality_fraction = float(self.counts.sum() / self.samples) if self.samples else 0.0
+
+        return ModeCoverage(modes_covered, high_quality_fraction, self.counts.copy())
+
+def _normal_windows(centres, std, lo, step, size, truncate):
+    # Pixel indices and density values of the 1D gaussians at each centre over a window of
+    # pixels covering truncate standard deviations, zeroed where the window leaves the image
+    width = int(np.floor(2*truncate*std / step)) + 2
+    first = np.ceil((centres - truncate*std - lo) / step - 0.5).astype(np.intp)
+    index = first[:, None] + np.arange(width)
+
+    values = (lo + (index + 0.5)*step - centres[:, None]) / std
+    values = np.exp(-0.5*values**2) / (std*np.sqrt(2*np.pi))
+    values *= (index >= 0) & (index < size)
+
+    return index, values
+
+def _dense_windows(index, values, start, stop):
+    # Scatter each row's window of values into the dense pixel range [start, stop)
+    dense = np.zeros((len(index), stop - start))
+    local = index - start
+    inside = (local >= 0) & (local < stop - start)
+    dense[np.nonzero(inside)[0], local[inside]] = values[inside] # A window never repeats a pixel
+
+    return dense
+
+def density_image(dataset, width=512, height=None, extent=None, margin=4, truncate=5, out=None, **kwargs):
+    """ Rasterize the ground-truth density of a dataset configuration's gaussian mixture.
+
+    Each pixel holds the mixture density at its centre. With a diagonal covariance every gaussian
+    is the outer product of an x and a y 1D kernel, so each tile of the image is the product
+    GY^T diag(weights) GX over the modes whose kernel windows overlap it. Each mode only costs the
+    few tiles around it, instead of evaluating every mode at every pixel, and the image is written
+    straight into out without a float64 copy.
+    Full covariances are evaluated directly with the truncated log_prob.
+
+    Parameters
+    ----------
+    dataset : function
+        One of GridGaussianDataset, CircularGaussianDataSet or ArchimedeanSpiralDataSet.
+
+    width : int, optional (default=512)
+        The number of pixel columns.
+
+    height : int or None, optional (default=None)
+        The number of pixel rows. If None then it equals width.
+
+    extent : tuple of 4 floats or None, optional (default=None)
+        The (xmin, xmax, ymin, ymax) region covered by the image. If None then it is the bounding
+        box of the means padded by margin standard deviations.
+
+    margin : float, optional (default=4)
+        The padding of the default extent, in standard deviations.
+
+    truncate : float, optional (default=5)
+        The number of standard deviations beyond which a gaussian is ignored.
+
+    out : float32 array of shape [height, width] or None, optional (default=None)
+        A C-contiguous array the image is written into instead of allocating a new one.
+
+    **kwargs
+        Mode layout arguments of the dataset function, ie. rows, variance or sample_weights.
+
+    Returns
+    -------
+    image : float32 array of shape [height, width]
+        The density image. Row 0 is at ymin, so use origin="lower" with matplotlib's imshow.
+
+    extent : tuple of 4 floats
+        The (xmin, xmax, ymin, ymax) region covered by the image.
+    """
+
+    if kwargs.get("continuous"):
+        raise ValueError("density_image rasterizes the gaussian mixture. A continuous spiral has no closed form density.")
+
+    height = width if height is None else height
+    if width<1 or height<1:
+        raise ValueError("Invalid image size. Must be >0.")
+
+    _, means, cov, sample_weights = _get_layout(dataset, kwargs)
+    means = np.asarray(means, dtype=np.float64).reshape(-1, 2)
+    weights = _get_weights(len(means), sample_weights)
+    std = np.sqrt(np.diag(cov))
+
+    if extent is None:
+        lo, hi = _get_bounds(means, std, margin)
+        extent = (float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1]))
+    step_x = (extent[1] - extent[0]) / width
+    step_y = (extent[3] - extent[2]) / height
+
+    if out is None:
+        out = np.empty((height, width), dtype=np.float32)
+    elif out.dtype != np.float32 or out.shape != (height, width) or not out.flags.c_contiguous:
+        raise ValueError("Invalid out array. Must be a C-contiguous float32 array of shape [height, width].")
+
+    if cov[0, 1] != 0:
+        ### Evaluate the density at the pixel centres, a band of rows at a time
+        density = _MixtureDensity(means, cov, weights, truncate)
+        x = extent[0] + (np.arange(width) + 0.5)*step_x
+        rows = max(_BLOCK_SIZE // width, 1)
+        for start in range(0, height, rows):
+            y = extent[2] + (np.arange(start, min(start + rows, height)) + 0.5)*step_y
+            points = np.stack(np.broadcast_arrays(x[None, :], y[:, None]), axis=-1)
+            out[start:start+len(y)] = np.exp(density(points)).reshape(len(y), width)
+
+        return out, extent
+
+    ### Sum the outer products of each mode's x and y kernels, GY^T diag(weights) GX, tile by tile
+    # Each tile is a dense product over the modes whose windows overlap it, so the work runs in BLAS
+    rows, gy = _normal_windows(means[:, 1], std[1], extent[2], step_y, height, truncate)
+    cols, gx = _normal_windows(means[:, 0], std[0], extent[0], step_x, width, truncate)
+    first_row, first_col = rows[:, 0], cols[:, 0]
+    tile_rows, tile_cols = max(gy.shape[1], 64), max(gx.shape[1], 64)
+
+    ### Visit the modes a band of rows at a time, in chunks that bound the dense kernel matrices
+    order = np.argsort(first_row, kind="stable")
+    sorted_rows = first_row[order]
+    block_size = max(2**22 // max(tile_rows, tile_cols), 1)
+    for top in range(0, height, tile_rows):
+        bottom = min(top + tile_rows, height)
+        out[top:bottom] = 0
+        lo, hi = np.searchsorted(sorted_rows, [top - gy.shape[1] + 1, bottom])
+        for block in range(lo, hi, block_size):
+            band = order[block:min(block + block_size, hi)]
+            band = band[np.argsort(first_col[band], kind="stable")]
+            y = _dense_windows(rows[band], gy[band], top, bottom) * weights[band, None]
+
+            for left in range(0, width, tile_cols):
+                right = min(left + tile_cols, width)
+                start, stop = np.searchsorted(first_col[band], [left - gx.shape[1] + 1, right])
+                if start < stop:
+                    x = _dense_windows(cols[band[start:stop]], gx[band[start:stop]], left, right)
+                    out[top:bottom, left:right] += y[start:stop].T @ x
+
+    return out, extent